@@ -170,6 +170,34 @@ def add_arguments_transformer_common(group):
     group.add_argument(
         "--gmm_init", default=False, type=strtobool, help="GMM initialization"
     )
+    group.add_argument(
+        "--gmm_init_backend",
+        default="torch",
+        type=str,
+        choices=["torch", "sklearn"],
+        help="Backend of GMM initialization, batched EM in torch or sklearn per head",
+    )
+    group.add_argument(
+        "--compile_diagnostics",
+        default=False,
+        type=strtobool,
+        help="Compile the forward used to dump attention weights and CTC "
+        "probabilities with torch.compile of PyTorch 2.0+",
+    )
+    group.add_argument(
+        "--bf16_inference",
+        default=False,
+        type=strtobool,
+        help="Run the encoder and the decoder steps of recognition under "
+        "BF16 autocast on CUDA devices supporting it",
+    )
+    group.add_argument(
+        "--compile_dm_losses",
+        default=False,
+        type=strtobool,
+        help="Compile the KL/div/MI losses of the disentangled attention "
+        "with torch.compile of PyTorch 2.0+",
+    )
     group.add_argument(
         "--kl_weight", default=0.01, type=float, help="Loss weight of kl term"
     )
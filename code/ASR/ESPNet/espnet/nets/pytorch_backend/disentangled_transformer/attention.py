@@ -16,6 +16,103 @@ from torch.nn import functional as F
 
 from espnet.nets.pytorch_backend.transformer.attention import MultiHeadedAttention
 
+
+def _merge_kv_pre_hook(
+    state_dict,
+    prefix,
+    local_metadata,
+    strict,
+    missing_keys,
+    unexpected_keys,
+    error_msgs,
+):
+    # separate linear_k and linear_v layers were fused into linear_kv
+    for name in ("weight", "bias"):
+        key_k = prefix + "linear_k." + name
+        key_v = prefix + "linear_v." + name
+        if key_k in state_dict and key_v in state_dict:
+            state_dict[prefix + "linear_kv." + name] = torch.cat(
+                [state_dict.pop(key_k), state_dict.pop(key_v)], dim=0
+            )
+
+
+def dm_losses(z: torch.Tensor, approx_log_var: torch.Tensor, mu: torch.Tensor,
+              log_var: torch.Tensor, log_prior: torch.Tensor,
+              mi_estimation: bool=False
+              ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Compute the cluster probabilities and the KL/div/MI losses of DM attention.
+
+    Parameters:
+        z: [batch, heads, length, dim]
+        approx_log_var: [batch, heads, length]
+        mu: [heads, clusters, dim]
+        log_var: [heads, clsuters, dim]
+        log_prior: [heads, clusters]
+
+    Returns:
+        (probs, kl_loss, div_loss, mi_loss)
+    """
+    B, H, L, D = z.size()
+
+    # true distribution
+    z = z.unsqueeze(3) # B x H x L x 1 x D
+    mu = mu.unsqueeze(1) # H x 1 x C x D
+    approx_log_var = approx_log_var.unsqueeze(-1).unsqueeze(-1) # B x H x L x 1 x 1
+    approx_var = approx_log_var.exp() # B x H x L x 1 x 1
+
+    log_var = log_var.unsqueeze(1) # H x 1 x C x D        
+    var = log_var.exp()
+    log_prior = F.log_softmax(log_prior, dim=-1) # H x C
+
+    mse = (z - mu).pow(2)/var # B x H x L x C x D
+    log_pdf = -0.5*mse.sum(-1) - 0.5*log_var.sum(-1) - D*math.pi # B x H x L x C
+    log_pdf = log_pdf + log_prior.unsqueeze(1) # B x H x L x C
+    log_probs = F.log_softmax(log_pdf - log_pdf.max(dim=-1, keepdim=True).values.detach() + 5, dim=-1) # B x H x L x C
+    cluster_probs = log_probs.exp()
+
+    prior = log_prior.unsqueeze(0).unsqueeze(2).expand_as(log_probs).exp()
+    kl_distribution = F.kl_div(log_probs, prior, reduction="none").sum(-1).mean((1, 2)) # B
+    kl_distribution = kl_distribution + 0.5*(cluster_probs * (mse + approx_var/var + log_var).sum(-1)).sum(-1).mean((1, 2)) # B
+    kl_distribution = kl_distribution - 0.5*(1 + approx_log_var).sum(-1).mul(D).mean((1, 2, 3))
+    kl_loss = kl_distribution.view(-1, 1, 1)
+    del mse
+
+    div_loss = torch.einsum("bhqc,bhkc->bhqk", cluster_probs, cluster_probs)
+    eye = torch.eye(L, device=z.device, dtype=z.dtype)
+    div_loss = (div_loss - eye).pow(2)
+    mask = eye * 1.25 + (1 - eye) * 0.75
+    div_loss = (div_loss * mask).mean((1, 2, 3))
+
+    if mi_estimation:
+        pdf = (log_pdf - log_pdf.max().detach()).exp().sum(-1, keepdim=True) # B x H x L x C
+        mi_probs = F.normalize(cluster_probs*pdf, p=1., dim=2, eps=1e-6)  # B x H x L x C
+        mi_probs = torch.einsum("bilc,bjlc->blij", mi_probs, cluster_probs).clamp(max=1)
+        mask = 1 - torch.eye(H, device=z.device, dtype=z.dtype)
+        mi_loss = -(1 - mi_probs + 1e-6).log().mul(mask).mean((1, 2, 3)) * 10
+        mi_loss = mi_loss -(F.log_softmax(
+            torch.einsum("bhqc,bhkc->bhqk", cluster_probs, cluster_probs), dim=-1
+        ).diagonal(dim1=2, dim2=3).mean((1, 2)))
+    else:
+        mi_loss = torch.zeros_like(kl_loss)
+
+    return cluster_probs, kl_loss, div_loss, mi_loss
+
+
+_compiled_dm_losses = None
+
+
+def compiled_dm_losses():
+    """Return dm_losses compiled by torch.compile (PyTorch 2.0+).
+
+    TorchInductor fuses the pointwise ops and reductions of the losses into
+    a few kernels. The function is compiled lazily on the first request.
+    """
+    global _compiled_dm_losses
+    if _compiled_dm_losses is None:
+        _compiled_dm_losses = torch.compile(dm_losses, dynamic=True)
+    return _compiled_dm_losses
+
+
 class DisentangledMaskAttention(nn.Module):
     """Multi-Head Attention layer (Disentangled attention).
 
@@ -35,11 +132,12 @@ class DisentangledMaskAttention(nn.Module):
         self.d_k = n_feat // n_head
         self.h = n_head
         self.linear_q = nn.Linear(n_feat, n_feat)
-        self.linear_k = nn.Linear(n_feat, n_feat)
-        self.linear_v = nn.Linear(n_feat, n_feat)
+        # key and value projections stacked in one layer, (key; value)
+        self.linear_kv = nn.Linear(n_feat, 2 * n_feat)
         self.linear_out = nn.Linear(n_feat, n_feat)
         self.attn = None
         self.dropout = nn.Dropout(p=dropout_rate)
+        self._register_load_state_dict_pre_hook(_merge_kv_pre_hook)
         self.var_estimation = var_estimation
 
         self.clusters = clusters
@@ -73,11 +171,13 @@ class DisentangledMaskAttention(nn.Module):
         if var_estimation:
             self.linear_head_var = nn.Linear(n_feat, n_head)
 
-        self.num_updates = nn.Parameter(torch.zeros((1,)), requires_grad=False)
+        # annealing step, replaced by the shared step counter of the owning model
+        self.register_buffer("num_updates", torch.zeros((1,)), persistent=False)
         self.outputs_dict: Dict[str, torch.Tensor] = {}
 
         self.init_params()
         self.debug = False
+        self.compile_losses = False
 
         if var_estimation:
             nn.init.xavier_normal_(self.linear_semantic_var.weight, gain=0.01)
@@ -89,6 +189,29 @@ class DisentangledMaskAttention(nn.Module):
         for p in self.parameters():
             if p.dim() > 1 and p.numel() > 1:
                 nn.init.xavier_normal_(p)
+        # same scale as two separate key and value layers
+        for w in self.linear_kv.weight.data.chunk(2, dim=0):
+            nn.init.xavier_normal_(w)
+
+    def forward_kv(self, key, value):
+        """Apply the key and value projections.
+
+        A key that is also the value is projected by a single matmul.
+
+        Args:
+            key (torch.Tensor): Key tensor (#batch, time2, size).
+            value (torch.Tensor): Value tensor (#batch, time2, size).
+
+        Returns:
+            torch.Tensor: Projected key tensor (#batch, time2, size).
+            torch.Tensor: Projected value tensor (#batch, time2, size).
+
+        """
+        if key is value:
+            return self.linear_kv(key).chunk(2, dim=-1)
+        weight_k, weight_v = self.linear_kv.weight.chunk(2, dim=0)
+        bias_k, bias_v = self.linear_kv.bias.chunk(2, dim=0)
+        return F.linear(key, weight_k, bias_k), F.linear(value, weight_v, bias_v)
 
     def normal_reparameterizing(self, x: torch.Tensor, log_var: torch.Tensor)-> torch.Tensor:
         """
@@ -118,9 +241,11 @@ class DisentangledMaskAttention(nn.Module):
 
         """
         n_batch = query.size(0)
-        q = self.linear_q(query).view(n_batch, -1, self.h, self.d_k)
-        k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
-        v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
+        q = self.linear_q(query)
+        k, v = self.forward_kv(key, value)
+        q = q.view(n_batch, -1, self.h, self.d_k)
+        k = k.view(n_batch, -1, self.h, self.d_k)
+        v = v.view(n_batch, -1, self.h, self.d_k)
         q = q.transpose(1, 2)  # (batch, head, time1, d_k)
         k = k.transpose(1, 2)  # (batch, head, time2, d_k)
         v = v.transpose(1, 2)  # (batch, head, time2, d_k)
@@ -188,50 +313,10 @@ class DisentangledMaskAttention(nn.Module):
         log_var = log_var.float()
         log_prior = log_prior.float()
 
-        # true distribution
-        z = z.unsqueeze(3) # B x H x L x 1 x D
-        mu = mu.unsqueeze(1) # H x 1 x C x D
-        approx_log_var = approx_log_var.unsqueeze(-1).unsqueeze(-1) # B x H x L x 1 x 1
-        approx_var = approx_log_var.exp() # B x H x L x 1 x 1
-
-        log_var = log_var.unsqueeze(1) # H x 1 x C x D        
-        var = log_var.exp()
-        log_prior = F.log_softmax(log_prior, dim=-1) # H x C
-
-        mse = (z - mu).pow(2)/var # B x H x L x C x D
-        log_pdf = -0.5*mse.sum(-1) - 0.5*log_var.sum(-1) - D*math.pi # B x H x L x C
-        log_pdf = log_pdf + log_prior.unsqueeze(1) # B x H x L x C
-        log_probs = F.log_softmax(log_pdf - log_pdf.max(dim=-1, keepdim=True).values.detach() + 5, dim=-1) # B x H x L x C
-        cluster_probs = log_probs.exp()
-
-        prior = log_prior.unsqueeze(0).unsqueeze(2).expand_as(log_probs).exp()
-        kl_distribution = F.kl_div(log_probs, prior, reduction="none").sum(-1).mean((1, 2)) # B
-        kl_distribution = kl_distribution + 0.5*(cluster_probs * (mse + approx_var/var + log_var).sum(-1)).sum(-1).mean((1, 2)) # B
-        kl_distribution = kl_distribution - 0.5*(1 + approx_log_var).sum(-1).mul(D).mean((1, 2, 3))
-        kl_loss = kl_distribution.view(-1, 1, 1)
-        del mse
-
-        div_loss = torch.einsum("bhqc,bhkc->bhqk", cluster_probs, cluster_probs)
-        div_loss = (div_loss - torch.eye(L).to(x)).pow(2)
-        mask = torch.eye(L) * 1.25 + (1 - torch.eye(L)) * 0.75
-        mask = mask.to(x)
-        div_loss = (div_loss * mask).mean((1, 2, 3))
-
-        if mi_estimation:
-            pdf = (log_pdf - log_pdf.max().detach()).exp().sum(-1, keepdim=True) # B x H x L x C
-            mi_probs = F.normalize(cluster_probs*pdf, p=1., dim=2, eps=1e-6)  # B x H x L x C
-            mi_probs = torch.einsum("bilc,bjlc->blij", mi_probs, cluster_probs).clamp(max=1)
-            mask = 1 - torch.eye(H).to(x)
-            mi_loss = -(1 - mi_probs + 1e-6).log().mul(mask).mean((1, 2, 3)) * 10
-            mi_loss = mi_loss -(F.log_softmax(
-                torch.einsum("bhqc,bhkc->bhqk", cluster_probs, cluster_probs), dim=-1
-            ).diagonal(dim1=2, dim2=3).mean((1, 2)))
-        else:
-            mi_loss = torch.zeros_like(kl_loss)
-
-        del log_pdf, log_probs, mask
-
-        z = z.squeeze(3)
+        losses_fn = compiled_dm_losses() if self.compile_losses else dm_losses
+        cluster_probs, kl_loss, div_loss, mi_loss = losses_fn(
+            z, approx_log_var, mu, log_var, log_prior, mi_estimation
+        )
 
         return z, cluster_probs, kl_loss, div_loss, mi_loss
 
@@ -256,6 +341,9 @@ class DisentangledMaskAttention(nn.Module):
                     "mi_loss": [batch, 1, 1],
                     "annealing_weight": [batch, 1, 1],
 
+                    "capture": [batch, length q, 2, heads, dim] if debug = True,
+                    "hidden_states": [batch, length q, heads, dim] if debug = True,
+                    "query": [batch, length q, heads, dim] if debug = True,
                     "cluster_probs_q": [batch, heads, length q, clusters] if debug = True,
                     "cluster_probs_k": [batch, heads, length k, clusters] if debug = True,
                     "mi_cluster_probs": [batch, heads, length q, clusters] if debug = True,
@@ -278,9 +366,14 @@ class DisentangledMaskAttention(nn.Module):
         else:
             log_var = self.var.log()
 
-        query = query.view(B, L_Q, H, D_K).transpose(2, 1)
+        query = query.view(B, L_Q, H, D_K)
         if self.debug:
-            outputs.update({"hidden_states": query})
+            # hidden states and queries are captured into one contiguous tensor
+            # in the (batch, length, 2, heads, dim) layout
+            capture = query.new_empty(B, L_Q, 2, H, D_K)
+            capture[:, :, 0] = query
+            outputs.update({"capture": capture, "hidden_states": capture[:, :, 0]})
+        query = query.transpose(2, 1)
 
         query, cluster_probs_q, cluster_loss_q, cluster_div_loss_q, _ = self.clustering(
             query,
@@ -329,8 +422,9 @@ class DisentangledMaskAttention(nn.Module):
 
         # 3. Linaer projection
         query = self.linear_q(query)
-        key = self.linear_k(key).view(B, L_K, H, D_K).transpose(2, 1) # B x H x L x D
-        value = self.linear_v(value).view(B, L_K, H, D_K).transpose(2, 1) # B x H x L x D
+        key, value = self.forward_kv(key, value)
+        key = key.view(B, L_K, H, D_K).transpose(2, 1) # B x H x L x D
+        value = value.view(B, L_K, H, D_K).transpose(2, 1) # B x H x L x D
 
         # 4. Disentanglement head attention
         if self.var_estimation:
@@ -350,7 +444,8 @@ class DisentangledMaskAttention(nn.Module):
         query = query.to(input_dtype)
 
         if self.debug:
-            outputs.update({"query": query})
+            capture[:, :, 1] = query.transpose(2, 1)
+            outputs.update({"query": capture[:, :, 1]})  # B x L x H x D
 
         cluster_loss = cluster_loss + mi_cluster_loss
         cluster_div_loss = cluster_div_loss + cluster_div_loss_mi
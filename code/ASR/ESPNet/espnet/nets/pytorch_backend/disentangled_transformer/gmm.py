@@ -0,0 +1,88 @@
+"""Batched Gaussian mixture model fitting for GMM initialization."""
+
+import math
+
+import torch
+
+
+def batched_kmeans_plusplus(x, n_components, generator=None):
+    """Choose initial cluster centers with the k-means++ seeding.
+
+    :param torch.Tensor x: batch of samples (G, N, D)
+    :param int n_components: number of centers K
+    :param torch.Generator generator: random generator on the device of x
+    :return: centers (G, K, D)
+    :rtype: torch.Tensor
+    """
+    G, N, D = x.size()
+    idx = torch.randint(N, (G, 1), generator=generator, device=x.device)
+    center = x.gather(1, idx.unsqueeze(-1).expand(-1, -1, D))
+    centers = [center]
+    min_dist = torch.cdist(x, center).squeeze(-1).pow(2)  # (G, N)
+    for _ in range(1, n_components):
+        # sample the next centers proportionally to the squared distances
+        idx = torch.multinomial(min_dist + 1e-12, 1, generator=generator)
+        center = x.gather(1, idx.unsqueeze(-1).expand(-1, -1, D))
+        centers.append(center)
+        min_dist = torch.min(min_dist, torch.cdist(x, center).squeeze(-1).pow(2))
+    return torch.cat(centers, dim=1)
+
+
+def batched_diag_gmm_em(x, n_components, n_iter=100, tol=1e-3, reg_covar=1e-6, seed=0):
+    """Fit independent diagonal-covariance GMMs with the EM algorithm.
+
+    All mixtures are fitted at once on the device of x, so the E-step and
+    M-step of every mixture are computed by a few batched matrix
+    multiplications.
+
+    :param torch.Tensor x: batch of samples (G, N, D)
+    :param int n_components: number of mixture components K
+    :param int n_iter: maximum number of EM iterations
+    :param float tol: convergence threshold of the mean log-likelihood
+    :param float reg_covar: non-negative regularization added to the variances
+    :param int seed: seed of the random initialization
+    :return: means (G, K, D)
+    :rtype: torch.Tensor
+    :return: log variances (G, K, D)
+    :rtype: torch.Tensor
+    :return: log mixture weights (G, K)
+    :rtype: torch.Tensor
+    """
+    x = x.float()
+    G, N, D = x.size()
+    x2 = x.pow(2)
+
+    # initialize means with the k-means++ seeding
+    generator = torch.Generator(device=x.device).manual_seed(seed)
+    mu = batched_kmeans_plusplus(x, n_components, generator)
+    log_var = (x.var(dim=1, keepdim=True) + reg_covar).log()
+    log_var = log_var.expand(-1, n_components, -1)
+    log_prior = x.new_full((G, n_components), -math.log(n_components))
+
+    prev_ll = None
+    for _ in range(n_iter):
+        # E-step: log N(x | mu, var) + log prior, (G, N, K)
+        prec = (-log_var).exp()
+        mahalanobis = (
+            torch.einsum("gnd,gkd->gnk", x2, prec)
+            - 2 * torch.einsum("gnd,gkd->gnk", x, mu * prec)
+            + (mu.pow(2) * prec).sum(-1).unsqueeze(1)
+        )
+        log_det = log_var.sum(-1).unsqueeze(1) + D * math.log(2 * math.pi)
+        log_prob = -0.5 * (mahalanobis + log_det) + log_prior.unsqueeze(1)
+        log_norm = torch.logsumexp(log_prob, dim=-1, keepdim=True)
+        resp = (log_prob - log_norm).exp()
+
+        # M-step
+        nk = resp.sum(1) + 10 * torch.finfo(resp.dtype).eps  # (G, K)
+        mu = torch.einsum("gnk,gnd->gkd", resp, x) / nk.unsqueeze(-1)
+        var = torch.einsum("gnk,gnd->gkd", resp, x2) / nk.unsqueeze(-1) - mu.pow(2)
+        log_var = (var.clamp(min=0) + reg_covar).log()
+        log_prior = (nk / N).log()
+
+        ll = log_norm.mean(dim=(1, 2))
+        if prev_ll is not None and bool(((ll - prev_ll).abs() < tol).all()):
+            break
+        prev_ll = ll
+
+    return mu, log_var, log_prior
@@ -8,9 +8,25 @@
 
 import torch
 
+from espnet.nets.pytorch_backend.disentangled_transformer.attention import (
+    DisentangledMaskAttention,  # noqa: H301
+)
 from espnet.nets.pytorch_backend.transformer.layer_norm import LayerNorm
 
 
+def _initialize_weight(w, init_type):
+    if init_type == "xavier_uniform":
+        torch.nn.init.xavier_uniform_(w)
+    elif init_type == "xavier_normal":
+        torch.nn.init.xavier_normal_(w)
+    elif init_type == "kaiming_uniform":
+        torch.nn.init.kaiming_uniform_(w, nonlinearity="relu")
+    elif init_type == "kaiming_normal":
+        torch.nn.init.kaiming_normal_(w, nonlinearity="relu")
+    else:
+        raise ValueError("Unknown initialization: " + init_type)
+
+
 def initialize(model, init_type="pytorch"):
     """Initialize Transformer module.
 
@@ -23,16 +39,12 @@ def initialize(model, init_type="pytorch"):
     # weight init
     for p in model.parameters():
         if p.dim() > 1:
-            if init_type == "xavier_uniform":
-                torch.nn.init.xavier_uniform_(p.data)
-            elif init_type == "xavier_normal":
-                torch.nn.init.xavier_normal_(p.data)
-            elif init_type == "kaiming_uniform":
-                torch.nn.init.kaiming_uniform_(p.data, nonlinearity="relu")
-            elif init_type == "kaiming_normal":
-                torch.nn.init.kaiming_normal_(p.data, nonlinearity="relu")
-            else:
-                raise ValueError("Unknown initialization: " + init_type)
+            _initialize_weight(p.data, init_type)
+    # fused key/value projections are initialized as two separate layers
+    for m in model.modules():
+        if isinstance(m, DisentangledMaskAttention):
+            for w in m.linear_kv.weight.data.chunk(2, dim=0):
+                _initialize_weight(w, init_type)
     # bias init
     for p in model.parameters():
         if p.dim() == 1:
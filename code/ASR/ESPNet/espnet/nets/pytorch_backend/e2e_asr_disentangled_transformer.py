@@ -4,21 +4,22 @@
 """Transformer speech recognition model (pytorch)."""
 
 from argparse import Namespace
+import contextlib
 import logging
 import math
+import os
 
 import numpy
 import torch
 
 from espnet.nets.asr_interface import ASRInterface
-from espnet.nets.ctc_prefix_score import CTCPrefixScore
+from espnet.nets.ctc_prefix_score import CTCPrefixScoreTH
 from espnet.nets.e2e_asr_common import end_detect
 from espnet.nets.e2e_asr_common import ErrorCalculator
 from espnet.nets.pytorch_backend.ctc import CTC
 from espnet.nets.pytorch_backend.e2e_asr import CTC_LOSS_THRESHOLD
 from espnet.nets.pytorch_backend.e2e_asr import Reporter
 from espnet.nets.pytorch_backend.nets_utils import get_subsample
-from espnet.nets.pytorch_backend.nets_utils import make_non_pad_mask
 from espnet.nets.pytorch_backend.nets_utils import th_accuracy
 from espnet.nets.pytorch_backend.rnn.decoders import CTC_SCORING_RATIO
 from espnet.nets.pytorch_backend.disentangled_transformer.add_sos_eos import add_sos_eos
@@ -34,6 +35,7 @@ from espnet.nets.pytorch_backend.disentangled_transformer.decoder import Decoder
 from espnet.nets.pytorch_backend.disentangled_transformer.dynamic_conv import DynamicConvolution
 from espnet.nets.pytorch_backend.disentangled_transformer.dynamic_conv2d import DynamicConvolution2D
 from espnet.nets.pytorch_backend.disentangled_transformer.encoder import Encoder
+from espnet.nets.pytorch_backend.disentangled_transformer.gmm import batched_diag_gmm_em
 from espnet.nets.pytorch_backend.disentangled_transformer.initializer import initialize
 from espnet.nets.pytorch_backend.disentangled_transformer.label_smoothing_loss import (
     LabelSmoothingLoss,  # noqa: H301
@@ -44,7 +46,33 @@ from espnet.nets.pytorch_backend.disentangled_transformer.plot import PlotAttent
 from espnet.nets.scorers.ctc import CTCPrefixScorer
 from espnet.utils.fill_missing_args import fill_missing_args
 
-from sklearn.mixture import GaussianMixture
+# modules keeping their last attention weights in `attn`
+_ATTN_TYPES = (
+    DisentangledMaskAttention,
+    MultiHeadedAttention,
+    DynamicConvolution,
+    RelPositionMultiHeadedAttention,
+)
+
+
+def _migrate_num_updates_pre_hook(
+    state_dict,
+    prefix,
+    local_metadata,
+    strict,
+    missing_keys,
+    unexpected_keys,
+    error_msgs,
+):
+    # per-module num_updates parameters were replaced by the global_step buffer
+    keys = [
+        k for k in state_dict if k.startswith(prefix) and k.endswith(".num_updates")
+    ]
+    if len(keys) > 0 and prefix + "global_step" not in state_dict:
+        state_dict[prefix + "global_step"] = state_dict[keys[0]].reshape(()).long()
+    for k in keys:
+        del state_dict[k]
+
 
 class E2E(ASRInterface, torch.nn.Module):
     """E2E module.
@@ -81,6 +109,7 @@ class E2E(ASRInterface, torch.nn.Module):
         :param Namespace args: argument Namespace containing options
         """
         torch.nn.Module.__init__(self)
+        self._register_load_state_dict_pre_hook(_migrate_num_updates_pre_hook)
 
         # fill missing arguments for compatibility
         args = fill_missing_args(args, self.add_arguments)
@@ -169,96 +198,265 @@ class E2E(ASRInterface, torch.nn.Module):
         
         self.initialization_tokens = 0 if args.gmm_init else 50001
         self.max_initialization_tokens = 50000
+        # host buffers of the captured (hidden states, query) pairs of all layers,
+        # allocated lazily on the first collection step
         self.initialization_data = {
-            "enc_hidden_states": [],
-            "dec_hidden_states": [],
-            "dec_enc_hidden_states": [],
-            "enc_query": [],
-            "dec_query": [],
-            "dec_enc_query": []
+            "enc": None,
+            "dec": None,
+            "dec_enc": None
         }
+        self.initialization_cursor = dict.fromkeys(self.initialization_data, 0)
+        self.initialization_stream = None
         self.reinitialized = False if args.gmm_init else True
+        self.gmm_init_backend = args.gmm_init_backend
 
         self.num_updates = 0
+        # single step counter read by all DM attention modules for annealing
+        self.register_buffer("global_step", torch.zeros((), dtype=torch.long))
+
+        # BF16 autocast of the encoder and the decoder steps in decoding
+        self.bf16_inference = args.bf16_inference
+        if self.bf16_inference:
+            torch.backends.cuda.matmul.allow_tf32 = True
+
+        # pinned staging buffers (by device, dtype) and copy stream of _pack_to_host
+        self._host_buffers = dict()
+        self._harvest_stream = None
+        # forward compiled lazily for the diagnostics (PyTorch 2.0+)
+        self.compile_diagnostics = (
+            args.compile_diagnostics and hasattr(torch, "compile")
+        )
+        if args.compile_diagnostics and not self.compile_diagnostics:
+            logging.warning("torch.compile requires PyTorch 2.0+")
+        self._compiled_forward = None
+
+        # cache module references used on every training step
+        self._dm_modules = tuple(
+            m for m in self.modules() if isinstance(m, DisentangledMaskAttention)
+        )
+        self._share_global_step()
+        # var is declared frozen by DM attention, but it has always been trained
+        # (all parameters were unfrozen on every step once collection ended)
+        for m in self._dm_modules:
+            m.var.requires_grad_(True)
+        if args.compile_dm_losses:
+            if hasattr(torch, "compile"):
+                for m in self._dm_modules:
+                    m.compile_losses = True
+            else:
+                logging.warning("torch.compile requires PyTorch 2.0+")
+        # flat index of the modules harvested by the diagnostics
+        self._index_harvested_modules()
+
+    def _share_global_step(self):
+        """Let all DM attention modules read the step counter of this model."""
+        for m in self._dm_modules:
+            m.num_updates = self.global_step
+
+    def _apply(self, fn, *args, **kwargs):
+        """Apply fn to all tensors and share the converted step counter again."""
+        super()._apply(fn, *args, **kwargs)
+        self._share_global_step()
+        return self
+
+    def inference_autocast(self, device):
+        """Return the autocast context used for decoding on the device.
+
+        :param torch.device device: device of the inputs
+        :return: BF16 autocast on CUDA if enabled, else a no-op context
+        """
+        if (
+            self.bf16_inference
+            and device.type == "cuda"
+            and torch.cuda.is_bf16_supported()
+        ):
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def wrap_ddp(self, device_ids=None, output_device=None, bucket_cap_mb=25):
+        """Wrap the model with DistributedDataParallel.
+
+        Gradients are bucketed in place (gradient_as_bucket_view) to avoid
+        an extra copy of them. While GMM initialization is pending the graph
+        changes between steps, so unused parameters are searched instead of
+        using a static graph; wrap the model again once it has finished.
+
+        :param list device_ids: CUDA devices of this process
+        :param int output_device: device of the outputs
+        :param int bucket_cap_mb: bucket size of the gradient all-reduce
+        :return: wrapped model
+        :rtype: torch.nn.parallel.DistributedDataParallel
+        """
+        initializing = (
+            not self.reinitialized
+            or self.initialization_tokens < self.max_initialization_tokens
+        )
+        if initializing:
+            kwargs = {"find_unused_parameters": True}
+        else:
+            kwargs = {"static_graph": True}
+        return torch.nn.parallel.DistributedDataParallel(
+            self,
+            device_ids=device_ids,
+            output_device=output_device,
+            bucket_cap_mb=bucket_cap_mb,
+            gradient_as_bucket_view=True,
+            **kwargs,
+        )
 
     def gmm_pretraining(self, embeddings: torch.Tensor, clusters: int, mu: torch.Tensor, log_cov: torch.Tensor, log_prior: torch.Tensor):
-        embeddings = embeddings.numpy()
+        # sklearn is only needed by this backend, import it on first use
+        from sklearn.mixture import GaussianMixture
+
+        embeddings = embeddings.reshape(-1, embeddings.size(-1)).numpy()
 
-        gmm = GaussianMixture(n_components=clusters, random_state=0, covariance_type="diag", verbose=True).fit(embeddings)
+        gmm = GaussianMixture(
+            n_components=clusters, random_state=0, covariance_type="diag"
+        ).fit(embeddings)
 
         mu.data.copy_(torch.from_numpy(gmm.means_))
-        log_cov.data.copy_(torch.from_numpy(gmm.covariances_))
-        log_prior.data.copy_(torch.from_numpy(gmm.weights_))
+        log_cov.data.copy_(torch.from_numpy(gmm.covariances_).log())
+        log_prior.data.copy_(torch.from_numpy(gmm.weights_).log())
 
-    def initialize_model(self, initialize_disentangled_head=False):
-        for k, v in self.initialization_data.items():
-            self.initialization_data[k] = torch.cat(v, dim=0)
+    def batched_gmm_pretraining(self, jobs):
+        """Fit GMMs sharing the same data shape in one batched EM run.
 
-        H = self.initialization_data["enc_hidden_states"].size()[1]
+        Embeddings with more than two dimensions are flattened to (N, dim)
+        after they are stacked, which saves a copy of non-contiguous views.
 
-        for layer_idx, layer in enumerate(self.encoder.encoders):
-            for h in range(H):
-                logging.warning("Pretraining encoder GMM parameters ... (layer={}, head={})".format(layer_idx, h))
-                clusters = 8 #self.initialization_data["enc_hidden_states"].size()[-1]
-
-                self.gmm_pretraining(
-                    self.initialization_data["enc_hidden_states"][:self.max_initialization_tokens, h, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_self_attn.semantic_mu[h:h+1],
-                    layer.dm_self_attn.semantic_log_var[h:h+1],
-                    layer.dm_self_attn.semantic_log_prior[h:h+1]
+        :param list jobs: tuples of (embeddings, clusters, mu, log_cov, log_prior)
+        """
+        groups = {}
+        for job in jobs:
+            embeddings, clusters = job[0], job[1]
+            groups.setdefault((clusters, embeddings.size()), []).append(job)
+
+        for (clusters, size), group in groups.items():
+            embeddings = torch.stack([job[0] for job in group], dim=0)
+            embeddings = embeddings.view(len(group), -1, size[-1])
+            logging.warning(
+                "Pretraining {} GMMs in a batch ... (clusters={}, samples={})".format(
+                    len(group), clusters, embeddings.size(1)
                 )
-
-            if initialize_disentangled_head:
-                logging.warning("Pretraining encoder GMM parameters ... (layer={})".format(layer_idx))
-                self.gmm_pretraining(
-                    self.initialization_data["enc_query"][:self.max_initialization_tokens*H, :, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_self_attn.head_mu,
-                    layer.dm_self_attn.head_log_var,
-                    layer.dm_self_attn.head_log_prior
+            )
+            mu, log_cov, log_prior = batched_diag_gmm_em(embeddings, clusters)
+            del embeddings
+            for g, (_, _, p_mu, p_log_cov, p_log_prior) in enumerate(group):
+                p_mu.data.copy_(mu[g])
+                p_log_cov.data.copy_(log_cov[g])
+                p_log_prior.data.copy_(log_prior[g])
+
+    def store_initialization_data(self, key, data, capacity):
+        """Copy collected embeddings into the pre-allocated host buffer.
+
+        :param str key: name of the collected embeddings
+        :param torch.Tensor data: embeddings to append (N, ...)
+        :param int capacity: number of rows used for GMM pretraining
+        """
+        if self.initialization_data[key] is None:
+            # a normal tensor even when first called under inference mode,
+            # later training steps write into it
+            with torch.inference_mode(False):
+                self.initialization_data[key] = torch.empty(
+                    (capacity,) + data.size()[1:],
+                    dtype=data.dtype,
+                    pin_memory=data.is_cuda,
                 )
+        buf = self.initialization_data[key]
+        start = self.initialization_cursor[key]
+        n = min(data.size(0), buf.size(0) - start)
+        if n <= 0:
+            return
+
+        if data.is_cuda:
+            # copy on a side stream to overlap the transfer with the next forward
+            if self.initialization_stream is None:
+                self.initialization_stream = torch.cuda.Stream(device=data.device)
+            self.initialization_stream.wait_stream(
+                torch.cuda.current_stream(data.device)
+            )
+            with torch.cuda.stream(self.initialization_stream):
+                buf[start:start + n].copy_(data[:n], non_blocking=True)
+            data.record_stream(self.initialization_stream)
+        else:
+            buf[start:start + n].copy_(data[:n])
+        self.initialization_cursor[key] = start + n
+
+    def initialize_model(self, initialize_disentangled_head=False):
+        if self.initialization_stream is not None:
+            self.initialization_stream.synchronize()
+        if self.gmm_init_backend == "sklearn":
+            device = torch.device("cpu")
+        else:
+            # fit on the device of the model, the pinned buffers allow async copies
+            device = next(self.parameters()).device
+
+        # the GMMs are fitted layer by layer, so only the captured data of one
+        # layer is on the device at a time
+        for layer_idx, layer in enumerate(self.encoder.encoders):
+            self.layer_gmm_pretraining(
+                layer_idx,
+                [("enc", layer.self_attn)],
+                initialize_disentangled_head,
+                device,
+            )
 
         for layer_idx, layer in enumerate(self.decoder.decoders):
-            for h in range(H):
-                logging.warning("Pretraining decoder GMM parameters ... (layer={}, head={})".format(layer_idx, h))
-                clusters = 4 #self.initialization_data["dec_hidden_states"].size()[-1]
-
-                self.gmm_pretraining(
-                    self.initialization_data["dec_hidden_states"][:self.max_initialization_tokens, h, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_self_attn.semantic_mu[h:h+1],
-                    layer.dm_self_attn.semantic_log_var[h:h+1],
-                    layer.dm_self_attn.semantic_log_prior[h:h+1]
-                )
+            self.layer_gmm_pretraining(
+                layer_idx,
+                [("dec", layer.self_attn), ("dec_enc", layer.src_attn)],
+                initialize_disentangled_head,
+                device,
+            )
 
-                logging.warning("Pretraining decoder-encoder GMM parameters ... (layer={}, head={})".format(layer_idx, h))
-                self.gmm_pretraining(
-                    self.initialization_data["dec_enc_hidden_states"][:self.max_initialization_tokens, h, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_src_attn.semantic_mu[h:h+1],
-                    layer.dm_src_attn.semantic_log_var[h:h+1],
-                    layer.dm_src_attn.semantic_log_prior[h:h+1]
-                )
+    def layer_gmm_pretraining(
+        self, layer_idx, attns, initialize_disentangled_head, device
+    ):
+        """Fit the GMMs of one layer on its captured embeddings.
 
-            if initialize_disentangled_head:
-                logging.warning("Pretraining decoder GMM parameters ... (layer={})".format(layer_idx))
-                self.gmm_pretraining(
-                    self.initialization_data["dec_query"][:self.max_initialization_tokens*H, :, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_self_attn.head_mu,
-                    layer.dm_self_attn.head_log_var,
-                    layer.dm_self_attn.head_log_prior
-                )
+        Each GMM has as many components as the clusters of its DM attention.
 
-                logging.warning("Pretraining decoder-encoder  GMM parameters ... (layer={})".format(layer_idx))
-                self.gmm_pretraining(
-                    self.initialization_data["dec_enc_query"][:self.max_initialization_tokens*H, :, layer_idx].cpu(),
-                    clusters,
-                    layer.dm_src_attn.head_mu,
-                    layer.dm_src_attn.head_log_var,
-                    layer.dm_src_attn.head_log_prior
-                )
+        :param int layer_idx: index of the layer in the captured data
+        :param list attns: pairs of (name of the captured data, DM attention)
+        :param bool initialize_disentangled_head: also fit the head GMMs
+        :param torch.device device: device the GMMs are fitted on
+        """
+        jobs = []
+        for key, attn in attns:
+            n = min(self.initialization_cursor[key], self.max_initialization_tokens)
+            # (tokens, 2, heads, dim) slice of this layer, copied to the device alone
+            data = self.initialization_data[key][:n, :, :, layer_idx]
+            hidden_states = data[:, 0].to(device, non_blocking=True)
+            for h in range(hidden_states.size(1)):
+                jobs.append((
+                    hidden_states[:, h],
+                    attn.clusters,
+                    attn.semantic_mu[h:h+1],
+                    attn.semantic_log_var[h:h+1],
+                    attn.semantic_log_prior[h:h+1]
+                ))
+
+            if initialize_disentangled_head:
+                # the queries of all heads are one data set, (tokens, heads, dim)
+                # is flattened when the GMM is fitted
+                jobs.append((
+                    data[:, 1].to(device, non_blocking=True),
+                    attn.clusters,
+                    attn.head_mu,
+                    attn.head_log_var,
+                    attn.head_log_prior
+                ))
+
+        logging.warning(
+            "Pretraining {} GMMs ... (layer={}, backend={})".format(
+                len(jobs), layer_idx, self.gmm_init_backend
+            )
+        )
+        if self.gmm_init_backend == "sklearn":
+            for job in jobs:
+                self.gmm_pretraining(*job)
+        else:
+            self.batched_gmm_pretraining(jobs)
 
     def reset_parameters(self, args):
         """Initialize parameters."""
@@ -285,183 +483,170 @@ class E2E(ASRInterface, torch.nn.Module):
             self.initialization_tokens = 0
             self.reinitialized = True
 
-            self.initialization_data = {
-                "enc_hidden_states": [],
-                "dec_hidden_states": [],
-                "dec_enc_hidden_states": [],
-                "enc_query": [],
-                "dec_query": [],
-                "dec_enc_query": []
-            }
+            self.initialization_cursor = dict.fromkeys(self.initialization_data, 0)
             
-        if self.initialization_tokens < self.max_initialization_tokens:
-            for m in self.modules():
-                if isinstance(m, DisentangledMaskAttention):
-                    m.debug = True
-            self.requires_grad_(False)
-        else:
-            self.requires_grad_(True)
-            for m in self.modules():
-                if isinstance(m, DisentangledMaskAttention):
-                    m.debug = False
-                    m.num_updates.requires_grad_(False)
-
-        # 1. forward encoder
-        xs_pad = xs_pad[:, : max(ilens)]  # for data parallel
-        src_mask = make_non_pad_mask(ilens.tolist()).to(xs_pad.device).unsqueeze(-2)
-        hs_pad, hs_mask = self.encoder(xs_pad, src_mask)
-        self.hs_pad = hs_pad
-
-        # 2. forward decoder
-        if self.decoder is not None:
-            ys_in_pad, ys_out_pad = add_sos_eos(
-                ys_pad, self.sos, self.eos, self.ignore_id
-            )
-            ys_mask = target_mask(ys_in_pad, self.ignore_id)
-            pred_pad, pred_mask = self.decoder(ys_in_pad, ys_mask, hs_pad, hs_mask)
-            self.pred_pad = pred_pad
-
-            # 3. compute attention loss
-            loss_att = self.criterion(pred_pad, ys_out_pad)
-            self.acc = th_accuracy(
-                pred_pad.view(-1, self.odim), ys_out_pad, ignore_label=self.ignore_id
-            )
-        else:
-            loss_att = None
-            self.acc = None
-
-        # TODO(karita) show predicted text
-        # TODO(karita) calculate these stats
-        cer_ctc = None
-        if self.mtlalpha == 0.0:
-            loss_ctc = None
-        else:
-            batch_size = xs_pad.size(0)
-            hs_len = hs_mask.view(batch_size, -1).sum(1)
-            loss_ctc = self.ctc(hs_pad.view(batch_size, -1, self.adim), hs_len, ys_pad)
-            if not self.training and self.error_calculator is not None:
-                ys_hat = self.ctc.argmax(hs_pad.view(batch_size, -1, self.adim)).data
-                cer_ctc = self.error_calculator(ys_hat.cpu(), ys_pad.cpu(), is_ctc=True)
-            # for visualization
-            if not self.training:
-                self.ctc.softmax(hs_pad)
-
-        # 5. compute cer/wer
-        if self.training or self.error_calculator is None or self.decoder is None:
-            cer, wer = None, None
-        else:
-            ys_hat = pred_pad.argmax(dim=-1)
-            cer, wer = self.error_calculator(ys_hat.cpu(), ys_pad.cpu())
-
-        # 6. compute disentangled loss
-        loss_kl = []
-        loss_div = []
-        loss_mi = []
-
-        for m in self.modules():
-            if isinstance(m, DisentangledMaskAttention):
-                loss_kl.append(m.outputs_dict["loss_kl"])
-                loss_div.append(m.outputs_dict["loss_div"])
-                loss_mi.append(m.outputs_dict["loss_mi"])
-
-                m.num_updates += 1
-
-        loss_kl = torch.cat(loss_kl, dim=1).mean()
-        loss_div = torch.cat(loss_div, dim=1).mean()
-        loss_mi = torch.cat(loss_mi, dim=1).mean()
-
-        loss_cluster_data = float(loss_kl)
-        loss_cluster_div_data = float(loss_div)
-        loss_mi_data = float(loss_mi)
-
-        # copied from e2e_asr
-        alpha = self.mtlalpha
-        if alpha == 0:
-            self.loss = loss_att + self.kl_weight*loss_kl + self.div_weight*loss_div + self.mi_weight*loss_mi
-            loss_att_data = float(loss_att)
-            loss_ctc_data = None
-        elif alpha == 1:
-            self.loss = loss_ctc + self.kl_weight*loss_kl + self.div_weight*loss_div + self.mi_weight*loss_mi
-            loss_att_data = None
-            loss_ctc_data = float(loss_ctc)
-        else:
-            self.loss = (
-                alpha * loss_ctc +
-                (1 - alpha) * loss_att + 
-                self.kl_weight*loss_kl +
-                self.div_weight*loss_div +
-                self.mi_weight*loss_mi
-            )
-            loss_att_data = float(loss_att)
-            loss_ctc_data = float(loss_ctc)
-
-        loss_data = float(self.loss)
-        if loss_data < CTC_LOSS_THRESHOLD and not math.isnan(loss_data):
-            self.reporter.report(
-                loss_ctc_data, loss_att_data, self.acc, cer_ctc, cer, wer, loss_data,
-                loss_cluster_data, loss_cluster_div_data, loss_mi_data
-            )
-        else:
-            logging.warning("loss (=%f) is not correct", loss_data)
-
-        # collect embedding for GMM pretraining
-        if self.initialization_tokens < self.max_initialization_tokens:
-            logging.warning("Collecting embeddings ... {} ...".format(self.initialization_tokens))
-
-            hidden_states = []
-            query = []
-            for encoder in self.encoder.encoders:
-                B, H, L, D = encoder.dm_self_attn.outputs_dict["hidden_states"].size()
-                hidden_states.append(
-                    encoder.dm_self_attn.outputs_dict["hidden_states"].permute(0, 2, 1, 3).reshape(B*L, H, D).cpu()
-                )
-                query.append(
-                    encoder.dm_self_attn.outputs_dict["query"].permute(0, 2, 1, 3).reshape(B*L*H, D).cpu()
+        collecting = self.initialization_tokens < self.max_initialization_tokens
+        for m in self._dm_modules:
+            m.debug = collecting
+
+        # no gradients are needed while embeddings are collected for GMM pretraining
+        with torch.no_grad() if collecting else contextlib.nullcontext():
+            # 1. forward encoder
+            xs_pad, src_mask = self._trim_and_mask(xs_pad, ilens)
+            hs_pad, hs_mask = self.encoder(xs_pad, src_mask)
+            self.hs_pad = hs_pad
+
+            # 2. forward decoder
+            if self.decoder is not None:
+                ys_in_pad, ys_out_pad = add_sos_eos(
+                    ys_pad, self.sos, self.eos, self.ignore_id
                 )
-            self.initialization_data["enc_hidden_states"].append(torch.stack(hidden_states, dim=2))
-            self.initialization_data["enc_query"].append(torch.stack(query, dim=2))
-
-            hidden_states = []
-            query = []
-            for decoder in self.decoder.decoders:
-                B, H, L, D = decoder.dm_self_attn.outputs_dict["hidden_states"].size()
-                hidden_states.append(
-                    decoder.dm_self_attn.outputs_dict["hidden_states"].permute(0, 2, 1, 3).reshape(B*L, H, D).cpu()
+                ys_mask = target_mask(ys_in_pad, self.ignore_id)
+                pred_pad, pred_mask = self.decoder(ys_in_pad, ys_mask, hs_pad, hs_mask)
+                self.pred_pad = pred_pad
+
+                # 3. compute attention loss
+                loss_att = self.criterion(pred_pad, ys_out_pad)
+                self.acc = th_accuracy(
+                    pred_pad.view(-1, self.odim), ys_out_pad, ignore_label=self.ignore_id
                 )
-                query.append(
-                    decoder.dm_self_attn.outputs_dict["query"].permute(0, 2, 1, 3).reshape(B*L*H, D).cpu()
+            else:
+                loss_att = None
+                self.acc = None
+
+            # TODO(karita) show predicted text
+            # TODO(karita) calculate these stats
+            cer_ctc = None
+            if self.mtlalpha == 0.0:
+                loss_ctc = None
+            else:
+                batch_size = xs_pad.size(0)
+                hs_len = hs_mask.view(batch_size, -1).sum(1)
+                loss_ctc = self.ctc(hs_pad.view(batch_size, -1, self.adim), hs_len, ys_pad)
+                if not self.training and self.error_calculator is not None:
+                    ys_hat = self.ctc.argmax(hs_pad.view(batch_size, -1, self.adim)).data
+                    cer_ctc = self.error_calculator(ys_hat.cpu(), ys_pad.cpu(), is_ctc=True)
+                # for visualization
+                if not self.training:
+                    self.ctc.softmax(hs_pad)
+
+            # 5. compute cer/wer
+            if self.training or self.error_calculator is None or self.decoder is None:
+                cer, wer = None, None
+            else:
+                ys_hat = pred_pad.argmax(dim=-1)
+                cer, wer = self.error_calculator(ys_hat.cpu(), ys_pad.cpu())
+
+            # 6. compute disentangled loss
+            # every module reports (B, 1, 1) losses, so the mean over all modules
+            # equals the average of the per-module means
+            loss_kl = 0.0
+            loss_div = 0.0
+            loss_mi = 0.0
+
+            for m in self._dm_modules:
+                loss_kl = loss_kl + m.outputs_dict["loss_kl"].mean()
+                loss_div = loss_div + m.outputs_dict["loss_div"].mean()
+                loss_mi = loss_mi + m.outputs_dict["loss_mi"].mean()
+            self.global_step += 1
+
+            loss_kl = loss_kl / len(self._dm_modules)
+            loss_div = loss_div / len(self._dm_modules)
+            loss_mi = loss_mi / len(self._dm_modules)
+
+            # copied from e2e_asr
+            alpha = self.mtlalpha
+            if alpha == 0:
+                self.loss = loss_att + self.kl_weight*loss_kl + self.div_weight*loss_div + self.mi_weight*loss_mi
+            elif alpha == 1:
+                self.loss = loss_ctc + self.kl_weight*loss_kl + self.div_weight*loss_div + self.mi_weight*loss_mi
+            else:
+                self.loss = (
+                    alpha * loss_ctc +
+                    (1 - alpha) * loss_att + 
+                    self.kl_weight*loss_kl +
+                    self.div_weight*loss_div +
+                    self.mi_weight*loss_mi
                 )
-            self.initialization_data["dec_hidden_states"].append(torch.stack(hidden_states, dim=2))
-            self.initialization_data["dec_query"].append(torch.stack(query, dim=2))
-            
-            hidden_states = []
-            query = []
-            for decoder in self.decoder.decoders:
-                B, H, L, D = decoder.dm_self_attn.outputs_dict["hidden_states"].size()
-                hidden_states.append(
-                    decoder.dm_src_attn.outputs_dict["hidden_states"].permute(0, 2, 1, 3).reshape(B*L, H, D).cpu()
+
+            # transfer all reported values to the host with a single sync
+            reported = [self.loss, loss_kl, loss_div, loss_mi]
+            if alpha != 1:
+                reported.append(loss_att)
+            if alpha != 0:
+                reported.append(loss_ctc)
+            reported = torch.stack(
+                [v.detach().float().reshape(()) for v in reported]
+            ).tolist()
+            loss_data, loss_cluster_data = reported[:2]
+            loss_cluster_div_data, loss_mi_data = reported[2:4]
+            loss_att_data = reported[4] if alpha != 1 else None
+            loss_ctc_data = reported[-1] if alpha != 0 else None
+
+            if loss_data < CTC_LOSS_THRESHOLD and not math.isnan(loss_data):
+                self.reporter.report(
+                    loss_ctc_data, loss_att_data, self.acc, cer_ctc, cer, wer, loss_data,
+                    loss_cluster_data, loss_cluster_div_data, loss_mi_data
                 )
-                query.append(
-                    decoder.dm_src_attn.outputs_dict["query"].permute(0, 2, 1, 3).reshape(B*L*H, D).cpu()
+            else:
+                logging.warning("loss (=%f) is not correct", loss_data)
+
+            # collect embedding for GMM pretraining
+            if collecting:
+                logging.warning("Collecting embeddings ... {} ...".format(self.initialization_tokens))
+
+                captured_modules = (
+                    ("enc", [layer.self_attn for layer in self.encoder.encoders]),
+                    ("dec", [layer.self_attn for layer in self.decoder.decoders]),
+                    ("dec_enc", [layer.src_attn for layer in self.decoder.decoders]),
                 )
-            self.initialization_data["dec_enc_hidden_states"].append(torch.stack(hidden_states, dim=2))
-            self.initialization_data["dec_enc_query"].append(torch.stack(query, dim=2))
-            
-            self.initialization_tokens += B*L
+                for key, modules in captured_modules:
+                    B, L, _, H, D = modules[0].outputs_dict["capture"].size()
+                    # (batch, length, 2, heads, layers, dim)
+                    captures = torch.stack(
+                        [m.outputs_dict["capture"] for m in modules], dim=4
+                    )
+                    self.store_initialization_data(
+                        key,
+                        captures.view(B*L, 2, H, len(modules), D),
+                        self.max_initialization_tokens,
+                    )
+
+                self.initialization_tokens += B*L
 
-            if self.initialization_tokens >= self.max_initialization_tokens:
-                self.initialize_model(initialize_disentangled_head=self.reinitialized)
+                if self.initialization_tokens >= self.max_initialization_tokens:
+                    self.initialize_model(initialize_disentangled_head=self.reinitialized)
 
+        if collecting:
             fake_tensor_need_grad = torch.tensor([0.], requires_grad=True).to(self.loss)
 
             self.loss = self.loss + fake_tensor_need_grad
 
         return self.loss
 
+    def _trim_and_mask(self, xs_pad, ilens):
+        """Trim the padding of the batch and build the source mask.
+
+        :param torch.Tensor xs_pad: batch of padded source sequences (B, Tmax, idim)
+        :param torch.Tensor ilens: batch of lengths of source sequences (B)
+        :return: trimmed batch (B, max(ilens), idim)
+        :rtype: torch.Tensor
+        :return: source mask (B, 1, max(ilens))
+        :rtype: torch.Tensor
+        """
+        ilens = ilens.to(xs_pad.device)
+        xs_pad = xs_pad[:, : int(ilens.max())]  # for data parallel
+        # build the mask on the device of the inputs without a host round trip
+        src_mask = (
+            torch.arange(xs_pad.size(1), device=xs_pad.device)[None, :] < ilens[:, None]
+        ).unsqueeze(-2)
+        return xs_pad, src_mask
+
     def scorers(self):
         """Scorers."""
         return dict(decoder=self.decoder, ctc=CTCPrefixScorer(self.ctc, self.eos))
 
+    @torch.inference_mode()
     def encode(self, x):
         """Encode acoustic features.
 
@@ -470,10 +655,13 @@ class E2E(ASRInterface, torch.nn.Module):
         :rtype: torch.Tensor
         """
         self.eval()
-        x = torch.as_tensor(x).unsqueeze(0)
-        enc_output, _ = self.encoder(x, None)
+        # decode on the device of the model
+        x = torch.as_tensor(x, device=next(self.parameters()).device).unsqueeze(0)
+        with self.inference_autocast(x.device):
+            enc_output, _ = self.encoder(x, None)
         return enc_output.squeeze(0)
 
+    @torch.inference_mode()
     def recognize(self, x, recog_args, char_list=None, rnnlm=None, use_jit=False):
         """Recognize input speech.
 
@@ -493,7 +681,7 @@ class E2E(ASRInterface, torch.nn.Module):
             from itertools import groupby
 
             lpz = self.ctc.argmax(enc_output)
-            collapsed_indices = [x[0] for x in groupby(lpz[0])]
+            collapsed_indices = [x[0] for x in groupby(lpz[0].tolist())]
             hyp = [x for x in filter(lambda x: x != self.blank, collapsed_indices)]
             nbest_hyps = [{"score": 0.0, "yseq": [self.sos] + hyp}]
             if recog_args.beam_size > 1:
@@ -501,7 +689,8 @@ class E2E(ASRInterface, torch.nn.Module):
             # TODO(hirofumi0810): Implement beam search
             return nbest_hyps
         elif self.mtlalpha > 0 and recog_args.ctc_weight > 0.0:
-            lpz = self.ctc.log_softmax(enc_output)
+            # prefix scores are computed in FP32 on the device of the encoder
+            lpz = self.ctc.log_softmax(enc_output).float()
             lpz = lpz.squeeze(0)
         else:
             lpz = None
@@ -516,7 +705,6 @@ class E2E(ASRInterface, torch.nn.Module):
 
         # preprare sos
         y = self.sos
-        vy = h.new_zeros(1).long()
 
         if recog_args.maxlenratio == 0:
             maxlen = h.shape[0]
@@ -527,15 +715,17 @@ class E2E(ASRInterface, torch.nn.Module):
         logging.info("max output length: " + str(maxlen))
         logging.info("min output length: " + str(minlen))
 
-        # initialize hypothesis
+        # initialize hypothesis, its token ids are kept in yseq_buf until it ends
         if rnnlm:
-            hyp = {"score": 0.0, "yseq": [y], "rnnlm_prev": None}
+            hyp = {"score": 0.0, "rnnlm_prev": None}
         else:
-            hyp = {"score": 0.0, "yseq": [y]}
+            hyp = {"score": 0.0}
         if lpz is not None:
-            ctc_prefix_score = CTCPrefixScore(lpz.detach().numpy(), 0, self.eos, numpy)
-            hyp["ctc_state_prev"] = ctc_prefix_score.initial_state()
-            hyp["ctc_score_prev"] = 0.0
+            # vectorized scorer, computes the prefix scores of all hypotheses at once
+            ctc_prefix_score = CTCPrefixScoreTH(
+                lpz.detach().unsqueeze(0), [lpz.size(0)], 0, self.eos
+            )
+            ctc_state_prev = None
             if ctc_weight != 1.0:
                 # pre-pruning based on attention scores
                 ctc_beam = min(lpz.shape[-1], int(beam * CTC_SCORING_RATIO))
@@ -544,102 +734,129 @@ class E2E(ASRInterface, torch.nn.Module):
         hyps = [hyp]
         ended_hyps = []
 
-        import six
+        # token ids and scores of the live hypotheses are kept on the device as
+        # rows of preallocated buffers, in the order of hyps
+        yseq_buf = torch.full(
+            (beam, maxlen + 1), self.eos, dtype=torch.long, device=h.device
+        )
+        yseq_buf[0, 0] = y
+        next_yseq_buf = torch.empty_like(yseq_buf)
+        score_buf = torch.zeros(beam, device=h.device)
 
         traced_decoder = None
-        for i in six.moves.range(maxlen):
+        for i in range(maxlen):
             logging.debug("position " + str(i))
 
-            hyps_best_kept = []
-            for hyp in hyps:
-                vy[0] = hyp["yseq"][i]
-
-                # get nbest local scores and their ids
-                ys_mask = subsequent_mask(i + 1).unsqueeze(0)
-                ys = torch.tensor(hyp["yseq"]).unsqueeze(0)
+            # score all hypotheses with a single batched decoder call
+            n_hyps = len(hyps)
+            ys_mask = subsequent_mask(i + 1, device=h.device).unsqueeze(0)
+            ys = yseq_buf[:n_hyps, : i + 1]
+            memory = enc_output.expand(n_hyps, -1, -1)
+            with self.inference_autocast(h.device):
                 # FIXME: jit does not match non-jit result
                 if use_jit:
                     if traced_decoder is None:
                         traced_decoder = torch.jit.trace(
-                            self.decoder.forward_one_step, (ys, ys_mask, enc_output)
+                            self.decoder.forward_one_step, (ys, ys_mask, memory)
                         )
-                    local_att_scores = traced_decoder(ys, ys_mask, enc_output)[0]
+                    local_att_scores = traced_decoder(ys, ys_mask, memory)[0]
                 else:
                     local_att_scores = self.decoder.forward_one_step(
-                        ys, ys_mask, enc_output
+                        ys, ys_mask, memory
                     )[0]
+            local_att_scores = local_att_scores.float()
+
+            if rnnlm:
+                rnnlm_states = []
+                local_lm_scores = []
+                for k, hyp in enumerate(hyps):
+                    rnnlm_state, lm_scores = rnnlm.predict(
+                        hyp["rnnlm_prev"], ys[k, i : i + 1]
+                    )
+                    rnnlm_states.append(rnnlm_state)
+                    local_lm_scores.append(lm_scores)
+                local_lm_scores = torch.cat(local_lm_scores, dim=0)
+                local_scores = local_att_scores + recog_args.lm_weight * local_lm_scores
+            else:
+                local_scores = local_att_scores
 
+            if lpz is not None:
+                # pre-pruning based on attention scores, (n_hyps, ctc_beam)
+                local_best_scores, local_best_ids = torch.topk(
+                    local_att_scores, ctc_beam, dim=1
+                )
+                # (n_hyps, odim) scores relative to the prefix scores
+                ctc_scores, ctc_states = ctc_prefix_score(
+                    ys, ctc_state_prev, local_best_ids
+                )
+                local_scores = (1.0 - ctc_weight) * torch.gather(
+                    local_att_scores, 1, local_best_ids
+                ) + ctc_weight * torch.gather(ctc_scores, 1, local_best_ids)
                 if rnnlm:
-                    rnnlm_state, local_lm_scores = rnnlm.predict(hyp["rnnlm_prev"], vy)
-                    local_scores = (
-                        local_att_scores + recog_args.lm_weight * local_lm_scores
+                    local_scores += recog_args.lm_weight * torch.gather(
+                        local_lm_scores, 1, local_best_ids
                     )
-                else:
-                    local_scores = local_att_scores
 
-                if lpz is not None:
-                    local_best_scores, local_best_ids = torch.topk(
-                        local_att_scores, ctc_beam, dim=1
-                    )
-                    ctc_scores, ctc_states = ctc_prefix_score(
-                        hyp["yseq"], local_best_ids[0], hyp["ctc_state_prev"]
-                    )
-                    local_scores = (1.0 - ctc_weight) * local_att_scores[
-                        :, local_best_ids[0]
-                    ] + ctc_weight * torch.from_numpy(
-                        ctc_scores - hyp["ctc_score_prev"]
-                    )
-                    if rnnlm:
-                        local_scores += (
-                            recog_args.lm_weight * local_lm_scores[:, local_best_ids[0]]
-                        )
-                    local_best_scores, joint_best_ids = torch.topk(
-                        local_scores, beam, dim=1
-                    )
-                    local_best_ids = local_best_ids[:, joint_best_ids[0]]
-                else:
-                    local_best_scores, local_best_ids = torch.topk(
-                        local_scores, beam, dim=1
-                    )
+            # prune all (hypothesis, token) pairs jointly and transfer only
+            # the selected ids and scores to the host
+            n_cands = local_scores.size(1)
+            joint_scores = local_scores + score_buf[:n_hyps].unsqueeze(1)
+            _, joint_best_ids = torch.topk(
+                joint_scores.view(-1), min(beam, joint_scores.numel())
+            )
+            best_hyp_ids = torch.div(joint_best_ids, n_cands, rounding_mode="floor")
+            best_cand_ids = joint_best_ids - best_hyp_ids * n_cands
+            if lpz is not None:
+                best_tokens = local_best_ids.view(-1)[joint_best_ids]
+            else:
+                best_tokens = best_cand_ids
+            best_scores = joint_scores.view(-1)[joint_best_ids]
+            joint_best_scores = local_scores.view(-1)[joint_best_ids].tolist()
 
-                for j in six.moves.range(beam):
-                    new_hyp = {}
-                    new_hyp["score"] = hyp["score"] + float(local_best_scores[0, j])
-                    new_hyp["yseq"] = [0] * (1 + len(hyp["yseq"]))
-                    new_hyp["yseq"][: len(hyp["yseq"])] = hyp["yseq"]
-                    new_hyp["yseq"][len(hyp["yseq"])] = int(local_best_ids[0, j])
-                    if rnnlm:
-                        new_hyp["rnnlm_prev"] = rnnlm_state
-                    if lpz is not None:
-                        new_hyp["ctc_state_prev"] = ctc_states[joint_best_ids[0, j]]
-                        new_hyp["ctc_score_prev"] = ctc_scores[joint_best_ids[0, j]]
-                    # will be (2 x beam) hyps at most
-                    hyps_best_kept.append(new_hyp)
-
-                hyps_best_kept = sorted(
-                    hyps_best_kept, key=lambda x: x["score"], reverse=True
-                )[:beam]
+            best_hyp_ids_list = best_hyp_ids.tolist()
+            best_tokens_list = best_tokens.tolist()
+            hyps_best_kept = []
+            for j, hyp_id in enumerate(best_hyp_ids_list):
+                hyp = hyps[hyp_id]
+                new_hyp = {}
+                new_hyp["score"] = hyp["score"] + joint_best_scores[j]
+                if rnnlm:
+                    new_hyp["rnnlm_prev"] = rnnlm_states[hyp_id]
+                hyps_best_kept.append(new_hyp)
 
             # sort and get nbest
             hyps = hyps_best_kept
             logging.debug("number of pruned hypothes: " + str(len(hyps)))
-            if char_list is not None:
-                logging.debug(
-                    "best hypo: "
-                    + "".join([char_list[int(x)] for x in hyps[0]["yseq"][1:]])
-                )
+            debug = char_list is not None and logging.getLogger().isEnabledFor(
+                logging.DEBUG
+            )
+            if debug:
+                yseq = yseq_buf[best_hyp_ids_list[0], 1 : i + 1].tolist()
+                yseq.append(best_tokens_list[0])
+                logging.debug("best hypo: " + "".join([char_list[x] for x in yseq]))
 
             # add eos in the final loop to avoid that there are no ended hyps
             if i == maxlen - 1:
                 logging.info("adding <eos> in the last postion in the loop")
-                for hyp in hyps:
-                    hyp["yseq"].append(self.eos)
+            ended = [
+                token == self.eos or i == maxlen - 1 for token in best_tokens_list
+            ]
+            if any(ended):
+                # the token ids of ended hypotheses are copied to the host once
+                ended_ids = [j for j, e in enumerate(ended) if e]
+                ended_yseqs = iter(
+                    yseq_buf[best_hyp_ids[ended_ids], : i + 1].tolist()
+                )
 
             # add ended hypothes to a final list, and removed them from current hypothes
             # (this will be a probmlem, number of hyps < beam)
             remained_hyps = []
-            for hyp in hyps:
-                if hyp["yseq"][-1] == self.eos:
+            remained_ids = []
+            for j, hyp in enumerate(hyps):
+                if ended[j]:
+                    hyp["yseq"] = next(ended_yseqs) + [best_tokens_list[j]]
+                    if i == maxlen - 1:
+                        hyp["yseq"].append(self.eos)
                     # only store the sequence that has more than minlen outputs
                     # also add penalty
                     if len(hyp["yseq"]) > minlen:
@@ -651,6 +868,28 @@ class E2E(ASRInterface, torch.nn.Module):
                         ended_hyps.append(hyp)
                 else:
                     remained_hyps.append(hyp)
+                    remained_ids.append(j)
+
+            # move the surviving rows into the spare buffers
+            if len(remained_ids) > 0:
+                keep = joint_best_ids.new_tensor(remained_ids)
+                n_kept = len(remained_ids)
+                next_yseq_buf[:n_kept, : i + 1] = yseq_buf[best_hyp_ids[keep], : i + 1]
+                next_yseq_buf[:n_kept, i + 1] = best_tokens[keep]
+                yseq_buf, next_yseq_buf = next_yseq_buf, yseq_buf
+                score_buf[:n_kept] = best_scores[keep]
+                if lpz is not None:
+                    # forward probabilities (T, 2, n_hyps) and prefix scores of the
+                    # kept prefixes, candidates follow the order of local_best_ids
+                    r, log_psi = ctc_states[:2]
+                    ctc_state_prev = (
+                        r[:, :, best_hyp_ids[keep], best_cand_ids[keep]],
+                        log_psi[best_hyp_ids[keep], best_tokens[keep]]
+                        .unsqueeze(1)
+                        .expand(-1, log_psi.size(1)),
+                        0,
+                        1,
+                    )
 
             # end detection
             if end_detect(ended_hyps, i) and recog_args.maxlenratio == 0.0:
@@ -664,11 +903,9 @@ class E2E(ASRInterface, torch.nn.Module):
                 logging.info("no hypothesis. Finish decoding.")
                 break
 
-            if char_list is not None:
-                for hyp in hyps:
-                    logging.debug(
-                        "hypo: " + "".join([char_list[int(x)] for x in hyp["yseq"][1:]])
-                    )
+            if debug:
+                for yseq in yseq_buf[: len(hyps), 1 : i + 2].tolist():
+                    logging.debug("hypo: " + "".join([char_list[x] for x in yseq]))
 
             logging.debug("number of ended hypothes: " + str(len(ended_hyps)))
 
@@ -694,32 +931,318 @@ class E2E(ASRInterface, torch.nn.Module):
         )
         return nbest_hyps
 
-    def calculate_all_attentions(self, xs_pad, ilens, ys_pad):
+    def calculate_all_attentions(
+        self,
+        xs_pad,
+        ilens,
+        ys_pad,
+        layers=None,
+        batch_indices=None,
+        return_format="dict",
+        return_ctc_probs=False,
+    ):
         """E2E attention calculation.
 
+        Restricting the layers and utterances is recommended in training loops,
+        where only a few attention maps are plotted.
+
+        With return_ctc_probs=True, the CTC probabilities of the same forward
+        are returned as well, which saves the forward of calculate_all_ctc_probs
+        when both are plotted.
+
+        With return_format="packed", all attention weights are returned in one
+        contiguous array as (names, shapes, offsets, flat), the weights of
+        names[i] are flat[offsets[i]:offsets[i + 1]].reshape(shapes[i]).
+
         :param torch.Tensor xs_pad: batch of padded input sequences (B, Tmax, idim)
         :param torch.Tensor ilens: batch of lengths of input sequences (B)
         :param torch.Tensor ys_pad: batch of padded token id sequence tensor (B, Lmax)
+        :param Iterable[str] layers: names of the modules to harvest, all if None
+        :param Sequence[int] batch_indices: utterances to harvest, all if None
+        :param str return_format: "dict" or "packed"
+        :param bool return_ctc_probs: also return the CTC probabilities
         :return: attention weights (B, H, Lmax, Tmax)
         :rtype: float ndarray
+        :return: CTC probabilities (B, Tmax, vocab), None without CTC,
+            only if return_ctc_probs
+        :rtype: float ndarray
         """
+        if return_format not in ("dict", "packed"):
+            raise ValueError("unknown return_format: " + str(return_format))
+        ret, probs = self._forward_and_capture(
+            xs_pad,
+            ilens,
+            ys_pad,
+            want_attn=True,
+            want_ctc=return_ctc_probs and self.mtlalpha > 0,
+            layers=layers,
+            batch_indices=batch_indices,
+            packed=return_format == "packed",
+        )
+        if return_ctc_probs:
+            return ret, probs
+        return ret
+
+    def _forward_and_capture(
+        self,
+        xs_pad,
+        ilens,
+        ys_pad,
+        want_attn=True,
+        want_ctc=True,
+        layers=None,
+        batch_indices=None,
+        packed=False,
+    ):
+        """Run one diagnostic forward and harvest attention weights and CTC probs.
+
+        :param torch.Tensor xs_pad: batch of padded input sequences (B, Tmax, idim)
+        :param torch.Tensor ilens: batch of lengths of input sequences (B)
+        :param torch.Tensor ys_pad: batch of padded token id sequence tensor (B, Lmax)
+        :param bool want_attn: harvest the attention weights
+        :param bool want_ctc: harvest the CTC probabilities
+        :param Iterable[str] layers: names of the attention modules to harvest
+        :param Sequence[int] batch_indices: utterances of the attention weights
+        :param bool packed: return the attention weights packed in one array
+        :return: attention weights by module name, or (names, shapes, offsets,
+            flat) if packed, None if not harvested
+        :rtype: dict or tuple
+        :return: CTC probabilities, None if not harvested
+        :rtype: float ndarray
+        """
+        layers = None if layers is None else frozenset(layers)
+        if self._harvest_index_key != self._submodules_key():
+            self._index_harvested_modules()
+
+        # restore the mode of the caller, e.g. keep a model in eval mode
+        was_training = self.training
+        # diagnostic forwards do not count as updates of the annealing schedule
+        num_updates = self.num_updates
+        global_step = self.global_step.clone()
         self.eval()
-        with torch.no_grad():
-            self.forward(xs_pad, ilens, ys_pad)
-        ret = dict()
+        try:
+            with torch.inference_mode():
+                if want_attn:
+                    self._diagnostic_forward()(xs_pad, ilens, ys_pad)
+                else:
+                    # the CTC probabilities only depend on the encoder
+                    xs_pad, src_mask = self._trim_and_mask(xs_pad, ilens)
+                    hs_pad, _ = self.encoder(xs_pad, src_mask)
+                    self._ctc_module[1].softmax(hs_pad)
+        finally:
+            self.num_updates = num_updates
+            self.global_step.copy_(global_step)
+            if was_training:
+                self.train()
+
+        def select(t):
+            if batch_indices is not None:
+                t = t.index_select(0, torch.as_tensor(batch_indices, device=t.device))
+            return self._half_on_device(t)
+
+        attn_tensors = []
+        ctc_tensors = []
+        if want_attn:
+            for name, m, kind in self._attn_index:
+                if layers is not None and name not in layers:
+                    continue
+                if kind == 0 and m.attn is not None:
+                    attn_tensors.append((name, select(m.attn)))
+                elif kind == 1 and m.attn_t is not None:
+                    attn_tensors.append((name + "_time", select(m.attn_t)))
+                    attn_tensors.append((name + "_freq", select(m.attn_f)))
+        if (
+            want_ctc
+            and self._ctc_module is not None
+            and self._ctc_module[1].probs is not None
+        ):
+            ctc_tensors.append((self._ctc_module[0], self._ctc_module[1].probs))
+        # both are transferred with one synchronization, the attention weights
+        # are only plotted and upcast to FP32 while copied out of the staging
+        # buffer
+        attns, probs = self._pack_to_host(
+            [attn_tensors, ctc_tensors], upcast_half=True
+        )
+        probs = self._unpack(probs)[ctc_tensors[0][0]] if ctc_tensors else None
+        del attn_tensors, ctc_tensors
+        if want_attn:
+            # the maps are on the host now, do not keep them alive on the device
+            for _, m, kind in self._attn_index:
+                if kind == 0:
+                    m.attn = None
+                elif kind == 1:
+                    m.attn_t = None
+                    m.attn_f = None
+            if os.environ.get("ESPNET_EMPTY_CACHE_AFTER_ATTENTION", "0") == "1":
+                torch.cuda.empty_cache()
+            if not packed:
+                attns = self._unpack(attns)
+            elif len(attns) == 1:
+                attns = attns[0]
+            else:
+                # no weights, or weights of several dtypes
+                names, shapes, offsets, flats = [], [], [0], []
+                for block_names, block_shapes, block_offsets, flat in attns:
+                    names += block_names
+                    shapes += block_shapes
+                    offsets += (offsets[-1] + block_offsets[1:]).tolist()
+                    flats.append(flat.astype(numpy.float32, copy=False))
+                flat = (
+                    numpy.concatenate(flats) if flats else numpy.zeros(0, numpy.float32)
+                )
+                attns = (names, shapes, numpy.asarray(offsets), flat)
+        else:
+            attns = None
+
+        return attns, probs
+
+    def _diagnostic_forward(self):
+        """Return the forward function used by the diagnostics.
+
+        With compile_diagnostics, the forward is compiled on first use with
+        CUDA graphs (mode="reduce-overhead") and dynamic shapes, since Tmax
+        and Lmax vary across utterances.
+
+        :return: forward function
+        """
+        if not self.compile_diagnostics:
+            return self.forward
+        if self._compiled_forward is None:
+            self._compiled_forward = torch.compile(
+                self.forward, mode="reduce-overhead", dynamic=True
+            )
+        return self._compiled_forward
+
+    @staticmethod
+    def _half_on_device(t):
+        """Cast FP32 CUDA tensors to FP16 to halve their transfer size."""
+        if t.is_cuda and t.dtype == torch.float32:
+            return t.half()
+        return t
+
+    def _submodules_key(self):
+        """Return a key that changes when the direct submodules change."""
+        return (id(self._modules), tuple(self._modules.values()))
+
+    def _index_harvested_modules(self):
+        """Walk the module tree once and index the modules used by the diagnostics.
+
+        _attn_index holds tuples of (name, module, kind), kind is 0 for modules
+        keeping `attn` and 1 for DynamicConvolution2D (`attn_t` and `attn_f`).
+        _ctc_module holds (name, module) of the CTC module or None.
+        """
+        self._attn_index = []
+        self._ctc_module = None
         for name, m in self.named_modules():
-            if (
-                isinstance(m, DisentangledMaskAttention)
-                or isinstance(m, MultiHeadedAttention)
-                or isinstance(m, DynamicConvolution)
-                or isinstance(m, RelPositionMultiHeadedAttention)
-            ):
-                ret[name] = m.attn.cpu().numpy()
+            if isinstance(m, _ATTN_TYPES):
+                self._attn_index.append((name, m, 0))
             if isinstance(m, DynamicConvolution2D):
-                ret[name + "_time"] = m.attn_t.cpu().numpy()
-                ret[name + "_freq"] = m.attn_f.cpu().numpy()
-        self.train()
-        return ret
+                self._attn_index.append((name, m, 1))
+            if isinstance(m, CTC) and self._ctc_module is None:
+                self._ctc_module = (name, m)
+        self._harvest_index_key = self._submodules_key()
+
+    @staticmethod
+    def _unpack(blocks):
+        """Return views of packed host blocks by name.
+
+        :param list blocks: tuples of (names, shapes, offsets, flat)
+        :return: host arrays by name
+        :rtype: dict
+        """
+        host = dict()
+        for names, shapes, offsets, flat in blocks:
+            for i, name in enumerate(names):
+                host[name] = flat[offsets[i] : offsets[i + 1]].reshape(shapes[i])
+        return host
+
+    def _pack_to_host(self, parts, upcast_half=False):
+        """Transfer lists of tensors to the host packed into flat arrays.
+
+        The tensors of each list are packed into one block per device and
+        dtype. One pinned staging buffer is kept per device and dtype, it is
+        only reallocated when more memory is needed. The blocks are copied
+        out of it before returning, so the arrays stay valid after later
+        calls. CUDA blocks are copied asynchronously on a dedicated copy
+        stream and waited for once with an event.
+
+        :param list parts: lists of pairs of (name, torch.Tensor)
+        :param bool upcast_half: return FP16 blocks as FP32, the upcast is the
+            copy out of the staging buffer
+        :return: for each list, tuples of (names, shapes, offsets, flat), the
+            values of names[i] are flat[offsets[i]:offsets[i + 1]]
+        :rtype: list
+        """
+        blocks = []
+        for part, tensors in enumerate(parts):
+            groups = dict()
+            for name, t in tensors:
+                t = t.detach()
+                groups.setdefault((t.device, t.dtype), []).append((name, t))
+            for (device, dtype), group in groups.items():
+                if len(group) == 1:
+                    block = group[0][1].reshape(-1)
+                else:
+                    block = torch.cat([t.reshape(-1) for _, t in group])
+                blocks.append((
+                    part,
+                    [name for name, _ in group],
+                    [tuple(t.size()) for _, t in group],
+                    numpy.cumsum([0] + [t.numel() for _, t in group]),
+                    block,
+                ))
+
+        # staging memory needed per device and dtype
+        sizes = dict()
+        for *_, block in blocks:
+            if block.is_cuda:
+                key = (block.device, block.dtype)
+                sizes[key] = sizes.get(key, 0) + block.numel()
+        for (device, dtype), size in sizes.items():
+            buf = self._host_buffers.get((device, dtype))
+            if buf is None or buf.numel() < size:
+                with torch.inference_mode(False):
+                    buf = torch.empty(size, dtype=dtype, pin_memory=True)
+                self._host_buffers[(device, dtype)] = buf
+
+        stream = None
+        staged = []
+        cursors = dict.fromkeys(sizes, 0)
+        for *_, block in blocks:
+            if not block.is_cuda:
+                staged.append((block, False))
+                continue
+            device = block.device
+            if stream is None:
+                if (
+                    self._harvest_stream is None
+                    or self._harvest_stream.device != device
+                ):
+                    self._harvest_stream = torch.cuda.Stream(device=device)
+                stream = self._harvest_stream
+                stream.wait_stream(torch.cuda.current_stream(device))
+            key = (device, block.dtype)
+            start = cursors[key]
+            buf = self._host_buffers[key][start : start + block.numel()]
+            cursors[key] = start + block.numel()
+            with torch.cuda.stream(stream):
+                buf.copy_(block, non_blocking=True)
+            block.record_stream(stream)
+            staged.append((buf, True))
+        if stream is not None:
+            stream.record_event().synchronize()
+
+        packed = [[] for _ in parts]
+        for (part, names, shapes, offsets, _), (buf, is_staging) in zip(blocks, staged):
+            # copy out of the staging buffers, they are reused by the next call
+            if upcast_half and buf.dtype == torch.float16:
+                flat = buf.numpy().astype(numpy.float32)
+            elif is_staging:
+                flat = buf.numpy().copy()
+            else:
+                flat = buf.numpy()
+            packed[part].append((names, shapes, offsets, flat))
+        return packed
 
     def calculate_all_ctc_probs(self, xs_pad, ilens, ys_pad):
         """E2E CTC probability calculation.
@@ -731,14 +1254,12 @@ class E2E(ASRInterface, torch.nn.Module):
         :rtype: float ndarray
         """
         ret = None
-        if self.mtlalpha == 0:
+        if self._harvest_index_key != self._submodules_key():
+            self._index_harvested_modules()
+        if self.mtlalpha == 0 or self._ctc_module is None:
             return ret
 
-        self.eval()
-        with torch.no_grad():
-            self.forward(xs_pad, ilens, ys_pad)
-        for name, m in self.named_modules():
-            if isinstance(m, CTC) and m.probs is not None:
-                ret = m.probs.cpu().numpy()
-        self.train()
+        _, ret = self._forward_and_capture(
+            xs_pad, ilens, ys_pad, want_attn=False, want_ctc=True
+        )
         return ret
@@ -0,0 +1,68 @@
+import numpy
+import pytest
+import torch
+
+from espnet.nets.pytorch_backend.disentangled_transformer.gmm import (
+    batched_diag_gmm_em,  # noqa: H301
+    batched_kmeans_plusplus,  # noqa: H301
+)
+
+
+def make_clustered_data(n_groups=2, n_components=3, n_samples=600, dim=4, seed=0):
+    rng = numpy.random.RandomState(seed)
+    data = []
+    for _ in range(n_groups):
+        means = rng.randn(n_components, dim) * 10
+        stds = rng.uniform(0.5, 1.5, size=(n_components, dim))
+        labels = rng.randint(n_components, size=n_samples)
+        data.append(means[labels] + stds[labels] * rng.randn(n_samples, dim))
+    return numpy.stack(data).astype(numpy.float32)
+
+
+def match_components(ref_means, hyp_means):
+    # permutation mapping each reference component to the closest hypothesis one
+    dist = ((ref_means[:, None] - hyp_means[None]) ** 2).sum(-1)
+    perm = dist.argmin(1)
+    assert sorted(perm.tolist()) == list(range(len(ref_means)))
+    return perm
+
+
+def test_batched_diag_gmm_em_shapes():
+    x = torch.from_numpy(make_clustered_data(n_groups=3, n_components=2, dim=5))
+    mu, log_var, log_prior = batched_diag_gmm_em(x, 2, n_iter=5)
+    assert mu.size() == (3, 2, 5)
+    assert log_var.size() == (3, 2, 5)
+    assert log_prior.size() == (3, 2)
+    torch.testing.assert_close(log_prior.exp().sum(-1), torch.ones(3))
+
+
+def test_batched_kmeans_plusplus():
+    x = torch.from_numpy(make_clustered_data(n_groups=2, n_components=3))
+    generator = torch.Generator().manual_seed(0)
+    centers = batched_kmeans_plusplus(x, 3, generator)
+    assert centers.size() == (2, 3, 4)
+    for g in range(x.size(0)):
+        # every center is one of the samples of its group
+        assert bool((centers[g][:, None] == x[g][None]).all(-1).any(1).all())
+        # on well separated data the seeding picks distinct clusters
+        assert bool((torch.pdist(centers[g]) > 5).all())
+
+
+@pytest.mark.parametrize("n_components", [2, 3])
+def test_batched_diag_gmm_em_matches_sklearn(n_components):
+    mixture = pytest.importorskip("sklearn.mixture")
+    data = make_clustered_data(n_components=n_components)
+    mu, log_var, log_prior = batched_diag_gmm_em(torch.from_numpy(data), n_components)
+
+    for g in range(data.shape[0]):
+        gmm = mixture.GaussianMixture(
+            n_components=n_components, random_state=0, covariance_type="diag"
+        ).fit(data[g])
+        perm = match_components(gmm.means_, mu[g].numpy())
+        numpy.testing.assert_allclose(mu[g].numpy()[perm], gmm.means_, atol=5e-2)
+        numpy.testing.assert_allclose(
+            log_var[g].numpy()[perm], numpy.log(gmm.covariances_), atol=5e-2
+        )
+        numpy.testing.assert_allclose(
+            log_prior[g].numpy()[perm], numpy.log(gmm.weights_), atol=5e-2
+        )
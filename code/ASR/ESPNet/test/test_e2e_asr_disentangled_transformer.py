@@ -0,0 +1,369 @@
+import argparse
+
+import numpy
+import pytest
+import torch
+
+from espnet.nets.ctc_prefix_score import CTCPrefixScore
+from espnet.nets.pytorch_backend.disentangled_transformer.attention import (
+    DisentangledMaskAttention,  # noqa: H301
+)
+from espnet.nets.pytorch_backend.disentangled_transformer.mask import subsequent_mask
+from espnet.nets.pytorch_backend.e2e_asr_disentangled_transformer import E2E
+from espnet.nets.pytorch_backend.rnn.decoders import CTC_SCORING_RATIO
+import espnet.nets.pytorch_backend.lm.default as lm_pytorch
+
+
+def make_arg(**kwargs):
+    defaults = dict(
+        adim=4,
+        aheads=2,
+        dropout_rate=0.0,
+        transformer_attn_dropout_rate=None,
+        elayers=2,
+        eunits=8,
+        dlayers=2,
+        dunits=8,
+        enc_clusters=2,
+        dec_clusters=2,
+        sym_space="<space>",
+        sym_blank="<blank>",
+        transformer_init="pytorch",
+        transformer_input_layer="conv2d",
+        transformer_length_normalized_loss=True,
+        report_cer=False,
+        report_wer=False,
+        mtlalpha=0.3,
+        lsm_weight=0.001,
+        char_list=["<blank>", "a", "e", "i", "o", "u"],
+        ctc_type="builtin",
+    )
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def prepare(args, idim=10, odim=7, seed=0):
+    torch.manual_seed(seed)
+    model = E2E(idim, odim, args)
+    ilens = [30, 20]
+    x = torch.randn(len(ilens), max(ilens), idim)
+    for i, ilen in enumerate(ilens):
+        x[i, ilen:] = -1
+    return model, x, torch.tensor(ilens)
+
+
+def dm_modules(model):
+    return [
+        (name, m)
+        for name, m in model.named_modules()
+        if isinstance(m, DisentangledMaskAttention)
+    ]
+
+
+def test_load_baseline_num_updates():
+    args = make_arg()
+    model, _, _ = prepare(args)
+    # baseline checkpoints keep a num_updates parameter in every DM attention
+    state_dict = model.state_dict()
+    del state_dict["global_step"]
+    for name, _ in dm_modules(model):
+        state_dict[name + ".num_updates"] = torch.nn.Parameter(
+            torch.full((1,), 123.0), requires_grad=False
+        )
+
+    new_model, _, _ = prepare(args)
+    new_model.load_state_dict(state_dict)
+    assert int(new_model.global_step) == 123
+
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda"))
+    for device in devices:
+        new_model.to(device)
+        assert new_model.global_step.device.type == device.type
+        for _, m in dm_modules(new_model):
+            assert m.num_updates is new_model.global_step
+        new_model.global_step += 1
+        assert all(int(m.num_updates) == 124 for _, m in dm_modules(new_model))
+        new_model.global_step -= 1
+
+
+@pytest.mark.parametrize("strict", [True, False])
+def test_save_load_global_step(strict):
+    args = make_arg()
+    model, _, _ = prepare(args)
+    model.global_step.fill_(7)
+    state_dict = model.state_dict()
+    assert not any(k.endswith(".num_updates") for k in state_dict)
+
+    new_model, _, _ = prepare(args)
+    new_model.load_state_dict(state_dict, strict=strict)
+    assert int(new_model.global_step) == 7
+    for _, m in dm_modules(new_model):
+        assert m.num_updates is new_model.global_step
+
+
+def test_load_baseline_kv_projections():
+    args = make_arg()
+    model, _, _ = prepare(args)
+    # baseline checkpoints keep separate key and value projections
+    state_dict = model.state_dict()
+    for name, _ in dm_modules(model):
+        for p in ("weight", "bias"):
+            k, v = state_dict.pop(name + ".linear_kv." + p).chunk(2, dim=0)
+            state_dict[name + ".linear_k." + p] = k
+            state_dict[name + ".linear_v." + p] = v
+
+    new_model, _, _ = prepare(args, seed=1)
+    new_model.load_state_dict(state_dict)
+    for p, new_p in zip(model.parameters(), new_model.parameters()):
+        assert torch.equal(p, new_p)
+
+
+@pytest.mark.parametrize("init_type", ["pytorch", "xavier_normal"])
+def test_kv_projection_init_scale(init_type):
+    args = make_arg(adim=64, aheads=4, transformer_init=init_type)
+    model, _, _ = prepare(args)
+    for _, m in dm_modules(model):
+        weight_k, weight_v = m.linear_kv.weight.chunk(2, dim=0)
+        # each half is initialized like a separate (adim, adim) layer
+        expected = (1.0 / args.adim) ** 0.5
+        for w in (weight_k, weight_v):
+            assert abs(float(w.std()) - expected) < 0.2 * expected
+
+
+def baseline_recognize(model, x, recog_args, rnnlm=None):
+    # beam search decoding one hypothesis at a time, as it was done before the
+    # hypotheses were batched
+    enc_output = model.encode(x).unsqueeze(0)
+    ctc_weight = recog_args.ctc_weight
+    if ctc_weight > 0.0:
+        lpz = model.ctc.log_softmax(enc_output).squeeze(0)
+    else:
+        lpz = None
+    h = enc_output.squeeze(0)
+    beam = recog_args.beam_size
+    maxlen = max(1, int(recog_args.maxlenratio * h.size(0)))
+    minlen = int(recog_args.minlenratio * h.size(0))
+
+    hyp = {"score": 0.0, "yseq": [model.sos], "rnnlm_prev": None}
+    if lpz is not None:
+        ctc_prefix_score = CTCPrefixScore(lpz.numpy(), 0, model.eos, numpy)
+        hyp["ctc_state_prev"] = ctc_prefix_score.initial_state()
+        hyp["ctc_score_prev"] = 0.0
+        ctc_beam = min(lpz.shape[-1], int(beam * CTC_SCORING_RATIO))
+    hyps = [hyp]
+    ended_hyps = []
+    for i in range(maxlen):
+        hyps_best_kept = []
+        for hyp in hyps:
+            ys_mask = subsequent_mask(i + 1).unsqueeze(0)
+            ys = torch.tensor(hyp["yseq"]).unsqueeze(0)
+            local_att_scores, _ = model.decoder.forward_one_step(
+                ys, ys_mask, enc_output
+            )
+            local_scores = local_att_scores
+            if rnnlm:
+                vy = torch.tensor([hyp["yseq"][i]])
+                rnnlm_state, local_lm_scores = rnnlm.predict(hyp["rnnlm_prev"], vy)
+                local_scores = local_att_scores + recog_args.lm_weight * local_lm_scores
+            if lpz is not None:
+                _, local_best_ids = torch.topk(local_att_scores, ctc_beam, dim=1)
+                ctc_scores, ctc_states = ctc_prefix_score(
+                    hyp["yseq"], local_best_ids[0], hyp["ctc_state_prev"]
+                )
+                local_scores = (1.0 - ctc_weight) * local_att_scores[
+                    :, local_best_ids[0]
+                ] + ctc_weight * torch.from_numpy(ctc_scores - hyp["ctc_score_prev"])
+                if rnnlm:
+                    local_scores += (
+                        recog_args.lm_weight * local_lm_scores[:, local_best_ids[0]]
+                    )
+                local_best_scores, joint_best_ids = torch.topk(local_scores, beam, 1)
+                local_best_ids = local_best_ids[:, joint_best_ids[0]]
+            else:
+                local_best_scores, local_best_ids = torch.topk(local_scores, beam, 1)
+
+            for j in range(beam):
+                new_hyp = {}
+                new_hyp["score"] = hyp["score"] + float(local_best_scores[0, j])
+                new_hyp["yseq"] = hyp["yseq"] + [int(local_best_ids[0, j])]
+                if rnnlm:
+                    new_hyp["rnnlm_prev"] = rnnlm_state
+                if lpz is not None:
+                    new_hyp["ctc_state_prev"] = ctc_states[joint_best_ids[0, j]]
+                    new_hyp["ctc_score_prev"] = ctc_scores[joint_best_ids[0, j]]
+                hyps_best_kept.append(new_hyp)
+            hyps_best_kept = sorted(
+                hyps_best_kept, key=lambda x: x["score"], reverse=True
+            )[:beam]
+
+        hyps = hyps_best_kept
+        if i == maxlen - 1:
+            for hyp in hyps:
+                hyp["yseq"].append(model.eos)
+        remained_hyps = []
+        for hyp in hyps:
+            if hyp["yseq"][-1] == model.eos:
+                if len(hyp["yseq"]) > minlen:
+                    hyp["score"] += (i + 1) * recog_args.penalty
+                    if rnnlm:
+                        hyp["score"] += recog_args.lm_weight * rnnlm.final(
+                            hyp["rnnlm_prev"]
+                        )
+                    ended_hyps.append(hyp)
+            else:
+                remained_hyps.append(hyp)
+        hyps = remained_hyps
+        if len(hyps) == 0:
+            break
+
+    return sorted(ended_hyps, key=lambda x: x["score"], reverse=True)[
+        : min(len(ended_hyps), recog_args.nbest)
+    ]
+
+
+@pytest.mark.parametrize(
+    "ctc_weight, use_rnnlm, beam_size",
+    [
+        (ctc_weight, use_rnnlm, beam_size)
+        for ctc_weight in (0.0, 0.3)
+        for use_rnnlm in (False, True)
+        for beam_size in (1, 3)
+    ],
+)
+def test_recognize_matches_baseline(ctc_weight, use_rnnlm, beam_size):
+    args = make_arg()
+    model, x, ilens = prepare(args)
+    model.eval()
+    rnnlm = None
+    if use_rnnlm:
+        rnnlm = lm_pytorch.ClassifierWithState(
+            lm_pytorch.RNNLM(model.odim, 1, 4, typ="lstm")
+        )
+        rnnlm.eval()
+    recog_args = argparse.Namespace(
+        beam_size=beam_size,
+        penalty=0.1,
+        ctc_weight=ctc_weight,
+        maxlenratio=1.0,
+        lm_weight=0.3,
+        minlenratio=0.0,
+        nbest=beam_size,
+    )
+
+    feat = x[0, : ilens[0]].numpy()
+    with torch.no_grad():
+        expected = baseline_recognize(model, feat, recog_args, rnnlm)
+        nbest = model.recognize(feat, recog_args, rnnlm=rnnlm)
+
+    assert len(nbest) == len(expected)
+    for hyp, ref in zip(nbest, expected):
+        assert hyp["yseq"] == ref["yseq"]
+        assert hyp["score"] == pytest.approx(ref["score"], rel=1e-4, abs=1e-4)
+
+
+def test_calculate_all_attentions_return_ctc_probs():
+    args = make_arg()
+    model, x, ilens = prepare(args)
+    y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+    attns, probs = model.calculate_all_attentions(x, ilens, y, return_ctc_probs=True)
+    assert set(attns) == set(model.calculate_all_attentions(x, ilens, y))
+    numpy.testing.assert_allclose(
+        probs, model.calculate_all_ctc_probs(x, ilens, y), rtol=1e-5
+    )
+
+    model, x, ilens = prepare(make_arg(mtlalpha=0.0))
+    _, probs = model.calculate_all_attentions(x, ilens, y, return_ctc_probs=True)
+    assert probs is None
+
+
+def test_diagnostics_keep_global_step():
+    args = make_arg()
+    model, x, ilens = prepare(args)
+    y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+    model.train()
+    model(x, ilens, y)
+    step, num_updates = int(model.global_step), model.num_updates
+
+    model.calculate_all_attentions(x, ilens, y)
+    model.calculate_all_ctc_probs(x, ilens, y)
+    assert int(model.global_step) == step
+    assert model.num_updates == num_updates
+    assert model.training
+
+
+def test_calculate_all_attentions_packed():
+    args = make_arg()
+    model, x, ilens = prepare(args)
+    y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+    attns = model.calculate_all_attentions(x, ilens, y)
+    names, shapes, offsets, flat = model.calculate_all_attentions(
+        x, ilens, y, return_format="packed"
+    )
+    assert sorted(names) == sorted(attns)
+    assert flat.dtype == numpy.float32
+    for i, name in enumerate(names):
+        numpy.testing.assert_allclose(
+            flat[offsets[i] : offsets[i + 1]].reshape(shapes[i]), attns[name]
+        )
+
+
+def test_dm_var_is_trained():
+    args = make_arg()
+    model, x, ilens = prepare(args)
+    y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+    model.train()
+    model(x, ilens, y).backward()
+    for _, m in dm_modules(model):
+        assert m.var.requires_grad
+        assert m.var.grad is not None
+
+
+@pytest.mark.parametrize("backend", ["torch", "sklearn"])
+def test_gmm_initialization(backend):
+    if backend == "sklearn":
+        pytest.importorskip("sklearn")
+    args = make_arg(gmm_init=True, gmm_init_backend=backend)
+    model, x, ilens = prepare(args)
+    model.max_initialization_tokens = 16
+    y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+    before = {
+        name: (m.semantic_mu.clone(), m.semantic_log_var.clone())
+        for name, m in dm_modules(model)
+    }
+    model.train()
+    for _ in range(10):
+        model(x, ilens, y)
+        if model.initialization_tokens >= model.max_initialization_tokens:
+            break
+    assert model.initialization_tokens >= model.max_initialization_tokens
+    for name, m in dm_modules(model):
+        mu, log_var = before[name]
+        assert torch.isfinite(m.semantic_mu).all()
+        assert not torch.equal(m.semantic_mu, mu)
+        assert not torch.equal(m.semantic_log_var, log_var)
+
+
+@pytest.mark.skipif(
+    not torch.distributed.is_available(), reason="torch.distributed is not available"
+)
+def test_wrap_ddp(tmp_path):
+    torch.distributed.init_process_group(
+        "gloo", init_method="file://" + str(tmp_path / "store"), rank=0, world_size=1
+    )
+    try:
+        args = make_arg()
+        model, x, ilens = prepare(args)
+        y = torch.tensor([[1, 2, 3], [2, 3, -1]])
+        ddp_model = model.wrap_ddp()
+        ddp_model.train()
+        for _ in range(2):
+            ddp_model.zero_grad()
+            ddp_model(x, ilens, y).backward()
+        assert int(model.global_step) == 2
+        for _, m in dm_modules(model):
+            assert m.num_updates is model.global_step
+            assert m.var.grad is not None
+    finally:
+        torch.distributed.destroy_process_group()